@@ -13,59 +13,140 @@
 
 import argparse
 import abc
+import collections
+import csv
+import itertools
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import os
 import numpy as np
+import pandas as pd
+from numpy.random import default_rng, Generator, Philox, SeedSequence
 try:
-    import modin.pandas as pd
+    from numba import njit
 except ImportError:
-    import pandas as pd
-from numpy.random import default_rng, SeedSequence
+    # Numba is optional, without it the same code runs as plain Python
+    def njit(*args, **kwargs):
+        return lambda f: f
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pa_parquet
+except ImportError:
+    pa = None
 
 seed = 42
 
 
+@njit(cache=True)
+def _split_range_core(range_max, min_size, max_size, draws):
+    # Only integer arithmetic here, so that the result does not depend on
+    # whether the loop is compiled or not
+    num_parts = len(draws)
+    parts = np.empty(num_parts, dtype=np.int64)
+    middle_size = (max_size + min_size + 1) // 2
+    current = 0
+    for p in range(num_parts):
+        remaining_parts = num_parts - p
+        avg_remaining_size = (
+            range_max - current + remaining_parts // 2
+        ) // remaining_parts
+        delta = middle_size - avg_remaining_size
+        low = min_size
+        high = max_size
+        if delta > 0:
+            high = max(high - delta, low)
+        else:
+            low = min(low - delta, high)
+        # Map the draw from [min_size, max_size] onto [low, high]
+        size = low + (draws[p] - min_size) * (high - low + 1) // (
+            max_size - min_size + 1
+        )
+        parts[p] = size
+        current += size
+
+    return parts
+
+
 class DatasetGenerator(abc.ABC):
-    def __init__(self, output_file_name: str, reuse: bool, parallel: bool, num_cpus: int):
+    _chunk_size = 2**20
+    _write_buffer_size = 8 << 20
+
+    def __init__(
+        self,
+        output_file_name: str,
+        reuse: bool,
+        parallel: bool,
+        num_cpus: int,
+        parallel_backend: str = "threads",
+        output_format: str = "csv",
+    ):
+        assert (
+            output_format != "parquet" or pa is not None
+        ), "Parquet output requires pyarrow"
         self._output_file_name = output_file_name
         self._reuse = reuse
         self._parallel = parallel
         self._num_cpus = num_cpus
+        self._parallel_backend = parallel_backend
+        self._output_format = output_format
 
     @abc.abstractmethod
     def generate_check_args(self, **kwargs):
         pass
 
     @staticmethod
-    def _generate_int(rnd, records: int, series_params: tuple):
+    def _generate_int(rnd, records: int, dtype: str, series_params: tuple):
         low, high = series_params
-        return rnd.integers(low=low, high=high, size=records, endpoint=True)
+        return rnd.integers(low=low, high=high, size=records, endpoint=True, dtype=dtype)
 
     @staticmethod
-    def _generate_float(rnd, records: int, series_params: tuple):
+    def _generate_float(
+        rnd, records: int, dtype: str, series_params: tuple, out: np.ndarray = None
+    ):
         low, high = series_params
-        return rnd.uniform(low=low, high=high, size=records)
+        if out is None:
+            out = np.empty(records, dtype=dtype)
+        # Drawing directly in the column precision halves the memory traffic
+        # for float32 columns, scaling is done in place to avoid temporaries.
+        # numexpr is not used for the rescale: it was slower than these two
+        # passes and its thread pool competes with the chunk workers.
+        rnd.random(dtype=dtype, out=out)
+        out *= high - low
+        out += low
+        return out
 
     @staticmethod
-    def _generate_datetime(rnd, records: int, series_params: tuple):
+    def _generate_datetime(rnd, records: int, dtype: str, series_params: tuple):
         low, high = series_params
-        time_delta = high - low
-        int_delta_seconds = time_delta / np.timedelta64(1, "s")
+        int_delta_seconds = int((high - low) / np.timedelta64(1, "s"))
         int_series = rnd.integers(
-            low=0, high=int_delta_seconds, size=records, endpoint=True
+            low=0, high=int_delta_seconds, size=records, endpoint=True, dtype=np.int64
         )
-        time_delta_series = int_series.astype(np.timedelta64)
-        return time_delta_series + low
+        # Seconds are scaled to the declared unit and shifted by the lower bound
+        # in place, reinterpreting the integers afterwards is free unlike astype()
+        unit, _ = np.datetime_data(dtype)
+        int_series *= np.timedelta64(1, "s") // np.timedelta64(1, unit)
+        int_series += low.astype(dtype).astype(np.int64)
+        return int_series.view(dtype)
 
     @staticmethod
-    def _generate_categoricals(rnd, records: int, series_params: tuple):
-        return rnd.choice(series_params, size=records)
+    def _generate_categoricals(rnd, records: int, dtype: str, series_params: tuple):
+        # Codes use the smallest signed type that fits, which is one byte per row
+        # for up to 128 labels. The labels are formatted once per category on output.
+        codes_dtype = np.min_scalar_type(-len(series_params))
+        codes = rnd.integers(0, len(series_params), size=records, dtype=codes_dtype)
+        return pd.Categorical.from_codes(codes, categories=list(series_params))
 
     @staticmethod
-    def _generate_object(rnd, records: int, series_params: tuple):
-        return np.nan
+    def _generate_object(rnd, records: int, dtype: str, series_params: tuple):
+        # Object columns are all-NaN, they are emitted as empty fields on output
+        # and never materialized in memory
+        return None
 
 
+    _float_types = ("float64", "float32")
     _generators = {
         "int64": _generate_int.__func__,
         "int32": _generate_int.__func__,
@@ -77,78 +158,286 @@ class DatasetGenerator(abc.ABC):
     }
 
     @classmethod
-    def _generate_series(cls, params: list):
+    def _generate_series(cls, params: tuple, **kwargs):
         rnd, name, type_name, records, series_params = params
-        return name, pd.Series(
-            cls._generators[type_name](rnd, records, series_params), name=name
+        return name, cls._generators[type_name](
+            rnd, records, type_name, series_params, **kwargs
         )
 
-    def _generate_data(self, fields: dict, records_number: int):
-        generators = SeedSequence(seed).spawn(len(fields))
-        map_args = [
+    @classmethod
+    def _generate_chunk(cls, params: tuple):
+        chunk_idx, fields, records = params
+        # Every (chunk, column) pair gets its own non-overlapping Philox stream,
+        # jumping ahead is much cheaper than hashing a spawned SeedSequence.
+        bit_generator = Philox(seed)
+        first_stream = chunk_idx * len(fields)
+        # Float columns of the same dtype are filled in place into one
+        # preallocated block, which holds a contiguous row per column
+        float_columns = {}
+        for type_name in cls._float_types:
+            names = [name for name, field in fields.items() if field[0] == type_name]
+            block = np.empty((len(names), records), dtype=type_name)
+            float_columns.update(zip(names, block))
+
+        data = {}
+        for i, (name, field) in enumerate(fields.items()):
+            rnd = Generator(bit_generator.jumped(first_stream + i))
+            kwargs = {"out": float_columns[name]} if name in float_columns else {}
+            key, value = cls._generate_series(
+                (rnd, name, field[0], records, field[1:]), **kwargs
+            )
+            data[key] = value
+        return data
+
+    @staticmethod
+    def _concatenate_chunks(chunks: list):
+        data = {}
+        for name, value in chunks[0].items():
+            if value is None:
+                data[name] = None
+            elif isinstance(value, pd.Categorical):
+                data[name] = pd.api.types.union_categoricals(
+                    [chunk[name] for chunk in chunks]
+                )
+            else:
+                data[name] = np.concatenate([chunk[name] for chunk in chunks])
+        return data
+
+    def _generate_chunks(self, fields: dict, records_number: int):
+        # Rows are produced in fixed-size chunks, so memory usage is bounded by
+        # a few chunks per CPU (see _run_in_order) rather than by the whole
+        # dataset. Every chunk uses its own random streams, which keeps the
+        # output independent of the CPU count.
+        num_chunks = max(1, -(-records_number // self._chunk_size))
+        chunk_args = [
             (
-                default_rng(generators[i]),
-                column[0],
-                column[1][0],
-                records_number,
-                column[1][1:],
+                c,
+                fields,
+                min(self._chunk_size, records_number - c * self._chunk_size),
             )
-            for i, column in enumerate(fields.items())
+            for c in range(num_chunks)
         ]
 
-        if self._parallel:
+        if not self._parallel:
+            for arg in chunk_args:
+                yield self._generate_chunk(arg)
+        elif self._parallel_backend == "ray":
             import ray
 
-            if not ray.is_initialized():
-                ray_ver = [int(x) for x in ray.__version__.split(".")]
-                if ray_ver[0] < 1 or ray_ver[0] == 1 and ray_ver[1] <= 6:
-                    # Workaround for ray-1.6.0 problem with runtime_env parameter
-                    ray.init(num_cpus=self._num_cpus)
-                else:
-                    ray.init(num_cpus=self._num_cpus, runtime_env={"env_vars": {"__MODIN_AUTOIMPORT_PANDAS__": "1"}})
+            self._init_ray()
 
             @ray.remote
             def remote_map(f, obj):
                 return f(obj)
 
-            data = dict(
-                ray.get([remote_map.remote(self._generate_series, x) for x in map_args])
+            yield from self._run_in_order(
+                lambda arg: remote_map.remote(self._generate_chunk, arg),
+                ray.get,
+                chunk_args,
             )
         else:
-            data = {}
-            for arg in map_args:
-                key, value = self._generate_series(list(arg))
-                data[key] = value
+            # NumPy releases the GIL while filling arrays, so threads scale
+            # without the process startup and serialization costs of Ray
+            with ThreadPoolExecutor(max_workers=self._num_cpus or os.cpu_count()) as executor:
+                yield from self._run_in_order(
+                    lambda arg: executor.submit(self._generate_chunk, arg),
+                    Future.result,
+                    chunk_args,
+                )
 
-        return data
+    def _init_ray(self):
+        import ray
+
+        if ray.is_initialized():
+            return False
+        ray_ver = [int(x) for x in ray.__version__.split(".")]
+        if ray_ver[0] < 1 or ray_ver[0] == 1 and ray_ver[1] <= 6:
+            # Workaround for ray-1.6.0 problem with runtime_env parameter
+            ray.init(num_cpus=self._num_cpus)
+        else:
+            ray.init(num_cpus=self._num_cpus, runtime_env={"env_vars": {"__MODIN_AUTOIMPORT_PANDAS__": "1"}})
+        return True
+
+    def _run_in_order(self, submit, get_result, chunk_args: list):
+        # Results are consumed in order. One chunk per worker plus one more
+        # keeps every worker busy. With the writer queue of two chunks and the
+        # one being written, at most num_cpus + 4 chunks are alive at a time.
+        max_pending = (self._num_cpus or os.cpu_count()) + 1
+        pending = collections.deque()
+        for arg in chunk_args:
+            pending.append(submit(arg))
+            if len(pending) >= max_pending:
+                yield get_result(pending.popleft())
+        while pending:
+            yield get_result(pending.popleft())
+
+    def _generate_data(self, fields: dict, records_number: int):
+        return self._concatenate_chunks(
+            list(self._generate_chunks(fields, records_number))
+        )
+
+    def _output_file_with_extension(self):
+        # The extension of the output format is appended unless the name already
+        # has it, so that a file named .csv never holds Parquet data
+        extension = "." + self._output_format
+        if self._output_file_name.endswith(extension):
+            return self._output_file_name
+        return self._output_file_name + extension
 
     def _generate_and_write_data(
         self, fields: dict, output_file_name: str, records_number: int
     ):
-        data = self._generate_data(fields, records_number)
         print("Writing output to", output_file_name)
-        pd.DataFrame(data).to_csv(output_file_name, index=False)
+        self._write_output(self._generate_chunks(fields, records_number), output_file_name)
+
+    @staticmethod
+    def _chunk_length(chunk: dict):
+        return max((len(values) for values in chunk.values() if values is not None), default=0)
+
+    @staticmethod
+    def _format_column(values, records: int):
+        if values is None:
+            return itertools.repeat("", records)
+        if isinstance(values, pd.Categorical):
+            labels = np.array([str(c) for c in values.categories], dtype=object)
+            return labels[values.codes].tolist()
+        if values.dtype.kind == "M":
+            # Separate date and time with a space as Arrow does, patching the
+            # "T" in place is much cheaper than str.replace on every value.
+            # NaT is shorter than position 10 and is left alone.
+            strings = np.datetime_as_string(values, unit="s")
+            chars = strings.view(np.uint32).reshape(-1, strings.itemsize // 4)
+            chars[~np.isnat(values), 10] = ord(" ")
+            return strings.tolist()
+        if values.dtype == np.float32:
+            # tolist() would widen to float64 and print spurious digits
+            return values.astype(str).tolist()
+        return values.tolist()
+
+    @classmethod
+    def _to_arrow_table(cls, chunk: dict, timestamp_unit: str = None):
+        # Numeric arrays are wrapped without copying, object columns become
+        # null arrays that take no buffer at all
+        records = cls._chunk_length(chunk)
+        return pa.table(
+            {
+                name: pa.nulls(records)
+                if values is None
+                else cls._to_arrow_array(values, timestamp_unit)
+                for name, values in chunk.items()
+            }
+        )
+
+    @staticmethod
+    def _to_arrow_array(values, timestamp_unit: str = None):
+        if timestamp_unit is not None and values.dtype.kind == "M":
+            return pa.array(values, type=pa.timestamp(timestamp_unit))
+        return pa.array(values)
+
+    def _write_output(self, chunks, output_file_name: str):
+        if pa is None:
+            # The Python writer holds the GIL for most of its work, so there is
+            # little to overlap
+            self._write_chunks(chunks, output_file_name)
+            return
+
+        # The file is written by a background thread, so that generation of the
+        # next chunks overlaps with writing of the previous ones
+        queued = queue.Queue(maxsize=2)
+
+        def put(item):
+            # The writer does not consume anything once it has stopped
+            while not writing.done():
+                try:
+                    queued.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            writing = executor.submit(
+                self._write_chunks, iter(queued.get, None), output_file_name
+            )
+            try:
+                for chunk in chunks:
+                    if not put(chunk):
+                        break
+            finally:
+                put(None)
+            writing.result()
+
+    def _write_chunks(self, chunks, output_file_name: str):
+        if self._output_format == "parquet":
+            self._write_parquet(chunks, output_file_name)
+        elif pa is not None:
+            self._write_csv_arrow(chunks, output_file_name)
+        else:
+            self._write_csv_python(chunks, output_file_name)
+
+    @classmethod
+    def _write_arrow(cls, chunks, open_writer, timestamp_unit: str = None, **write_options):
+        tables = (cls._to_arrow_table(chunk, timestamp_unit) for chunk in chunks)
+        first = next(tables)
+        with open_writer(first.schema) as writer:
+            for table in itertools.chain([first], tables):
+                writer.write_table(table, **write_options)
+
+    @classmethod
+    def _write_parquet(cls, chunks, output_file_name: str):
+        # Every chunk becomes one row group. The row group size is passed
+        # explicitly, because the writer's default allows up to 64Mi rows and
+        # would put a larger table, such as Plasticc metadata, in one group.
+        cls._write_arrow(
+            chunks,
+            lambda schema: pa_parquet.ParquetWriter(
+                output_file_name, schema, compression="snappy", use_dictionary=True
+            ),
+            row_group_size=cls._chunk_size,
+        )
+
+    @classmethod
+    def _write_csv_arrow(cls, chunks, output_file_name: str):
+        # Arrow formats and writes the columns in multithreaded C++ code
+        write_options = pa_csv.WriteOptions(batch_size=65536)
+        cls._write_arrow(
+            chunks,
+            lambda schema: pa_csv.CSVWriter(
+                output_file_name, schema, write_options=write_options
+            ),
+            # Whole seconds, Arrow would print nanosecond timestamps with a
+            # fraction of zeros that the baseline to_csv did not write
+            timestamp_unit="s",
+        )
+
+    @classmethod
+    def _write_csv_python(cls, chunks, output_file_name: str):
+        # Formatting is done column-wise in bulk and rows are joined by the C csv
+        # writer, which avoids the per-cell Python overhead of DataFrame.to_csv.
+        # open() stacks FileIO, BufferedWriter and TextIOWrapper, only the
+        # buffer needs to be large enough to turn the rows into big writes
+        with open(
+            output_file_name,
+            "w",
+            newline="",
+            encoding="utf-8",
+            buffering=cls._write_buffer_size,
+        ) as f:
+            writer = csv.writer(f, lineterminator="\n")
+            for chunk_idx, chunk in enumerate(chunks):
+                if chunk_idx == 0:
+                    writer.writerow(chunk.keys())
+                records = cls._chunk_length(chunk)
+                columns = [cls._format_column(values, records) for values in chunk.values()]
+                writer.writerows(zip(*columns))
 
     @staticmethod
     def _split_range_into_random_parts(range_max, num_parts, min_size, max_size):
-        parts = []
         rnd = default_rng(SeedSequence(seed))
-        current = 0
-        for p in range(num_parts):
-            remaining = range_max - current
-            avg_remaining_size = round(remaining / (num_parts - p))
-            delta = round((max_size + min_size) / 2) - avg_remaining_size
-            low = min_size
-            high = max_size
-            if delta > 0:
-                high = max(high - delta, low)
-            else:
-                low = min(low - delta, high)
-            size = rnd.integers(low, high, endpoint=True)
-            parts.append(size)
-            current += size
-
-        return parts
+        draws = rnd.integers(
+            min_size, max_size, size=num_parts, endpoint=True, dtype=np.int64
+        )
+        return _split_range_core(range_max, min_size, max_size, draws)
 
 
 class TaxiGenerator(DatasetGenerator):
@@ -223,9 +512,10 @@ class TaxiGenerator(DatasetGenerator):
         self.generate(records)
 
     def generate(self, records: int):
+        output_file_name = self._output_file_with_extension()
         if not self._reuse:
-            self._generate_and_write_data(self._fields, self._output_file_name, records)
-        return self._output_file_name
+            self._generate_and_write_data(self._fields, output_file_name, records)
+        return output_file_name
 
 
 class CensusGenerator(DatasetGenerator):
@@ -286,9 +576,10 @@ class CensusGenerator(DatasetGenerator):
         self.generate(records)
 
     def generate(self, records: int):
+        output_file_name = self._output_file_with_extension()
         if not self._reuse:
-            self._generate_and_write_data(self._fields, self._output_file_name, records)
-        return self._output_file_name
+            self._generate_and_write_data(self._fields, output_file_name, records)
+        return output_file_name
 
 
 class PlasticcGenerator(DatasetGenerator):
@@ -388,12 +679,13 @@ class PlasticcGenerator(DatasetGenerator):
         training_set_metadata_records: int,
         test_set_metadata_records: int,
     ):
-        training_set_file = self._output_file_name + "_training_set.csv"
-        test_set_file = self._output_file_name + "_test_set.csv"
+        extension = "." + self._output_format
+        training_set_file = self._output_file_name + "_training_set" + extension
+        test_set_file = self._output_file_name + "_test_set" + extension
         training_set_metadata_file = (
-            self._output_file_name + "_training_set_metadata.csv"
+            self._output_file_name + "_training_set_metadata" + extension
         )
-        test_set_metadata_file = self._output_file_name + "_test_set_metadata.csv"
+        test_set_metadata_file = self._output_file_name + "_test_set_metadata" + extension
         if not self._reuse:
 
             def generate_dataset(
@@ -405,40 +697,53 @@ class PlasticcGenerator(DatasetGenerator):
                 data_fields,
                 metadata_fields,
             ):
-                metadata = pd.DataFrame(
-                    self._generate_data(metadata_fields, metadata_records)
-                )
+                metadata = self._generate_data(metadata_fields, metadata_records)
                 numbers = self._split_range_into_random_parts(
                     data_records, metadata_records, object_numbers[0], object_numbers[1]
                 )
-                data_records = sum(numbers)
-                data = pd.DataFrame(self._generate_data(data_fields, data_records))
-                ids = np.concatenate([np.repeat(np.array([x]), n) for (x, n) in zip(metadata["object_id"], numbers)])
-                data.insert(0, column="object_id", value=ids)
+                data_records = int(numbers.sum())
+                ids = np.repeat(metadata["object_id"], numbers)
+                data_chunks = (
+                    {"object_id": ids[start : start + self._chunk_size], **chunk}
+                    for start, chunk in zip(
+                        itertools.count(0, self._chunk_size),
+                        self._generate_chunks(data_fields, data_records),
+                    )
+                )
 
                 print("Writing output to", data_output)
-                data.to_csv(data_output, index=False)
+                self._write_output(data_chunks, data_output)
                 print("Writing output to", metadata_output)
-                metadata.to_csv(metadata_output, index=False)
-
-            generate_dataset(
-                training_set_records,
-                training_set_metadata_records,
-                self._training_set_objects_numbers,
-                training_set_file,
-                training_set_metadata_file,
-                self._training_set_fields,
-                self._training_set_metadata_fields,
-            )
-            generate_dataset(
-                test_set_records,
-                test_set_metadata_records,
-                self._test_set_objects_numbers,
-                test_set_file,
-                test_set_metadata_file,
-                self._test_set_fields,
-                self._test_set_metadata_fields,
+                self._write_output([metadata], metadata_output)
+
+            # One Ray session serves all four tables instead of starting it per table
+            ray_started = (
+                self._parallel and self._parallel_backend == "ray" and self._init_ray()
             )
+            try:
+                generate_dataset(
+                    training_set_records,
+                    training_set_metadata_records,
+                    self._training_set_objects_numbers,
+                    training_set_file,
+                    training_set_metadata_file,
+                    self._training_set_fields,
+                    self._training_set_metadata_fields,
+                )
+                generate_dataset(
+                    test_set_records,
+                    test_set_metadata_records,
+                    self._test_set_objects_numbers,
+                    test_set_file,
+                    test_set_metadata_file,
+                    self._test_set_fields,
+                    self._test_set_metadata_fields,
+                )
+            finally:
+                if ray_started:
+                    import ray
+
+                    ray.shutdown()
 
         return (
             training_set_file,
@@ -502,7 +807,8 @@ def main():
         "-o",
         "--output",
         required=True,
-        help="File name to write dataset or prefix (in case of plasticc)",
+        help="File name to write dataset or prefix (in case of plasticc). "
+        "The extension of the output format is appended if it is missing.",
     )
     parser.add_argument(
         "-np",
@@ -510,8 +816,29 @@ def main():
         action='store_true',
         help="Disable parallel dataset generation.",
     )
+    parser.add_argument(
+        "-pb",
+        "--parallel-backend",
+        choices=["threads", "ray"],
+        default="threads",
+        help="Backend for parallel dataset generation. Ray is only worth it for distributed runs.",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["parquet", "csv"],
+        default="parquet",
+        help="Output file format. Parquet requires pyarrow.",
+    )
     args = parser.parse_args()
-    gen = generators[args.mode](args.output, False, not args.no_parallel, os.cpu_count())
+    gen = generators[args.mode](
+        args.output,
+        False,
+        not args.no_parallel,
+        os.cpu_count(),
+        args.parallel_backend,
+        args.format,
+    )
     kwargs = vars(args)
     gen.generate_check_args(**kwargs)
 
@@ -6,7 +6,7 @@ import time
 from collections import OrderedDict
 
 import os
-# Need to set it early before importing generator classes because they import Modin
+# Need to set it early before importing benchmarks because they import Modin
 # and this variable has to be set already in case modin experimental API is needed later.
 os.environ["MODIN_EXPERIMENTAL"] = "true"
 